@@ -4,15 +4,11 @@ Combines RAG-only and Full-featured modes with Knowledge Base management
 """
 
 import streamlit as st
-import sys
 import os
 import json
 from datetime import datetime
 from dotenv import load_dotenv
 
-# Add src to path for imports
-sys.path.append(os.path.join(os.path.dirname(__file__), 'src'))
-
 from src.travel_planner_agent import TravelPlannerAgent
 from src.utils.tts import create_audio_button
 
@@ -121,7 +117,7 @@ if "travel_agent" not in st.session_state:
                     st.sidebar.info(f"📚 Records: {stats['total_vectors']}")
                 index_name = os.getenv("PINECONE_INDEX_NAME", "travel-agency")
                 st.sidebar.info(f"📂 Index: {index_name}")
-            except:
+            except Exception:
                 pass
             
         except Exception as e:
@@ -415,33 +411,23 @@ elif selected_page == "📚 Knowledge Base":
     st.title("📚 Knowledge Base")
     st.markdown("*Quản lý cơ sở dữ liệu kiến thức du lịch*")
     
-    # Stats row
+    # Stats row (index stats fetched once per render)
     col1, col2, col3, col4 = st.columns(4)
+    try:
+        stats = rag_system.get_index_stats()
+    except Exception:
+        stats = {}
     
     with col1:
-        try:
-            stats = rag_system.get_index_stats()
-            st.metric("📊 Records", stats.get('total_vectors', 0))
-        except:
-            st.metric("📊 Records", "0")
+        st.metric("📊 Records", stats.get('total_vectors', 0))
     
     with col2:
-        try:
-            stats = rag_system.get_index_stats()
-            dimension = stats.get('dimension', 1536)
-            st.metric("📐 Dimension", dimension)
-        except:
-            st.metric("📐 Dimension", "1536")
+        st.metric("📐 Dimension", stats.get('dimension', 1536))
     
     with col3:
-        try:
-            stats = rag_system.get_index_stats()
-            database_name = stats.get('database', type(rag_system).__name__.replace('RAGSystem', ''))
-            st.metric("🗃️ Database", database_name)
-        except:
-            # Fallback to RAG system class name
-            rag_type = type(rag_system).__name__.replace('RAGSystem', '')
-            st.metric("🗃️ Database", rag_type)
+        # Fallback to RAG system class name
+        database_name = stats.get('database', type(rag_system).__name__.replace('RAGSystem', ''))
+        st.metric("🗃️ Database", database_name)
     
     with col4:
         if st.button("➕ Tạo mới", type="primary", use_container_width=True):
@@ -2,9 +2,18 @@
 Pinecone RAG System - Retrieval-Augmented Generation with Pinecone Vector Database
 """
 
+import copy
 import os
-import json
-from typing import Dict, Any, List, Optional
+import re
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, as_completed, wait
+from functools import lru_cache
+from typing import Dict, Any, List, Optional, Tuple
+import ijson
+import numpy as np
+import orjson
 from pinecone import Pinecone, ServerlessSpec
 from openai import AzureOpenAI
 import logging
@@ -12,6 +21,53 @@ import logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Matches the [CHUNK_X] citation markers the LLM inserts into answers
+_CHUNK_REF_RE = re.compile(r'\[CHUNK_(\d+)\]')
+
+# Static instructions for cited answers. Kept byte-identical across calls
+# (context and question go in the user message) so the provider can reuse
+# the cached prompt prefix.
+_RAG_SYSTEM_PROMPT = """Bạn là trợ lý du lịch thông minh chuyên về du lịch Việt Nam.
+
+Dựa vào THÔNG TIN THAM KHẢO được cung cấp để trả lời CÂU HỎI của khách hàng.
+
+HƯỚNG DẪN QUAN TRỌNG:
+- Trả lời bằng tiếng Việt
+- BẮT BUỘC: Khi sử dụng thông tin từ chunk nào, PHẢI ghi [CHUNK_X] ngay sau thông tin đó
+- Ví dụ: "Hà Nội có Hồ Hoàn Kiếm [CHUNK_1] và phố cổ với 36 phố phường [CHUNK_2]"
+- Nếu thông tin không đủ để trả lời, hãy trả lời "NO_RELEVANT_INFO"
+- Chỉ sử dụng thông tin từ các chunk được cung cấp
+- Trả lời chi tiết và hữu ích
+
+Hãy trả lời và nhớ ghi rõ [CHUNK_X] cho mỗi thông tin sử dụng."""
+
+
+def _convert_metadata_value(value: Any) -> Any:
+    """Convert a metadata value of any other type (e.g. subclasses) for Pinecone"""
+    if isinstance(value, (str, int, float, bool)):
+        return value
+    elif isinstance(value, list):
+        return [str(item) for item in value]
+    elif isinstance(value, dict):
+        return _dumps_metadata_dict(value)
+    return str(value)
+
+
+def _dumps_metadata_dict(value: Dict) -> str:
+    """Serialize a dict metadata value to a UTF-8 JSON string"""
+    return orjson.dumps(value, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")
+
+
+# Pinecone-compatible converters for metadata values, keyed by exact type
+_METADATA_CONVERTERS = {
+    str: lambda value: value,
+    int: lambda value: value,
+    float: lambda value: value,
+    bool: lambda value: value,
+    list: lambda value: [str(item) for item in value],
+    dict: _dumps_metadata_dict,
+}
+
 
 class PineconeRAGSystem:
     """
@@ -39,6 +95,35 @@ class PineconeRAGSystem:
             azure_endpoint=self.azure_embedding_endpoint,
             api_version="2024-07-01-preview"
         )
+        self.chat_client = AzureOpenAI(
+            api_key=self.azure_chat_api_key,
+            azure_endpoint=self.azure_chat_endpoint,
+            api_version="2024-07-01-preview"
+        )
+        
+        # In-process LRU cache of embeddings keyed by input text
+        self.embedding_cache_size = 1024
+        self._embedding_cache = OrderedDict()
+        self._embedding_cache_lock = threading.Lock()
+        
+        # Semantic cache of search results, stored as a ring buffer: one row of
+        # the float32 matrix per unit query vector, with its top_k and documents.
+        # A query close enough to a cached one reuses its results until they expire.
+        self.search_cache_size = 256
+        self.search_cache_threshold = 0.95
+        self.search_cache_ttl = 300  # seconds
+        self._search_cache_vectors = None  # allocated on first insert, once the dimension is known
+        self._search_cache_top_k = np.full(self.search_cache_size, -1, dtype=np.int32)  # -1 marks an empty slot
+        self._search_cache_expires = np.zeros(self.search_cache_size, dtype=np.float64)  # time.monotonic() deadline
+        self._search_cache_documents = [None] * self.search_cache_size
+        self._search_cache_next = 0
+        self._search_cache_lock = threading.Lock()
+        
+        # LRU cache of answered query() results keyed by normalized question and
+        # top_k: {key: (expires_at, result)}
+        self.query_cache_size = 512
+        self.query_cache_ttl = 300  # seconds
+        self._query_cache = OrderedDict()
         
         # Initialize index
         self.index = self._setup_index()
@@ -68,72 +153,194 @@ class PineconeRAGSystem:
             logger.error(f"Error setting up index: {e}")
             raise
     
+    def _cache_embedding(self, text: str, embedding: List[float]) -> None:
+        """Store an embedding in the LRU cache, evicting the oldest entry"""
+        with self._embedding_cache_lock:
+            self._embedding_cache[text] = embedding
+            self._embedding_cache.move_to_end(text)
+            while len(self._embedding_cache) > self.embedding_cache_size:
+                self._embedding_cache.popitem(last=False)
+    
     def get_embedding(self, text: str) -> List[float]:
-        """Get embedding for text using Azure OpenAI"""
+        """Get embedding for text using Azure OpenAI (cached per text)"""
+        with self._embedding_cache_lock:
+            cached = self._embedding_cache.get(text)
+            if cached is not None:
+                self._embedding_cache.move_to_end(text)
+                return cached
+        
         try:
             response = self.embedding_client.embeddings.create(
                 model=self.embed_model,
                 input=text
             )
-            return response.data[0].embedding
+            embedding = response.data[0].embedding
+            self._cache_embedding(text, embedding)
+            return embedding
         except Exception as e:
             logger.error(f"Error getting embedding: {e}")
             raise
     
+    def get_embeddings(self, texts: List[str], batch_size: int = 256) -> List[List[float]]:
+        """Get embeddings for many texts, sending them to Azure OpenAI in batches"""
+        embeddings = []
+        try:
+            for i in range(0, len(texts), batch_size):
+                response = self.embedding_client.embeddings.create(
+                    model=self.embed_model,
+                    input=texts[i:i + batch_size]
+                )
+                # Results carry their input position; keep input order
+                data = sorted(response.data, key=lambda item: item.index)
+                embeddings.extend(item.embedding for item in data)
+            return embeddings
+        except Exception as e:
+            logger.error(f"Error getting embeddings: {e}")
+            raise
+    
+    def _lookup_search_cache(self, query_vector: np.ndarray, top_k: int) -> Optional[List[Dict]]:
+        """Return cached documents for the most similar earlier query, if similar enough"""
+        with self._search_cache_lock:
+            if self._search_cache_vectors is None:
+                return None
+            
+            # Cosine similarity against every cached query in one matrix-vector product
+            similarities = self._search_cache_vectors @ query_vector
+            stale = (self._search_cache_top_k != top_k) | (self._search_cache_expires <= time.monotonic())
+            similarities[stale] = -1.0
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.search_cache_threshold:
+                return copy.deepcopy(self._search_cache_documents[best])
+        return None
+    
+    def _store_search_cache(self, query_vector: np.ndarray, top_k: int, documents: List[Dict]) -> None:
+        """Add search results to the cache, overwriting the oldest slot when full"""
+        with self._search_cache_lock:
+            if self._search_cache_vectors is None:
+                self._search_cache_vectors = np.zeros(
+                    (self.search_cache_size, query_vector.shape[0]), dtype=np.float32
+                )
+            slot = self._search_cache_next
+            self._search_cache_vectors[slot] = query_vector
+            self._search_cache_top_k[slot] = top_k
+            self._search_cache_expires[slot] = time.monotonic() + self.search_cache_ttl
+            self._search_cache_documents[slot] = copy.deepcopy(documents)  # callers may mutate their copy
+            self._search_cache_next = (slot + 1) % self.search_cache_size
+    
+    def clear_cache(self) -> None:
+        """Drop cached search results and answers; call after changing the index contents"""
+        with self._search_cache_lock:
+            self._search_cache_top_k.fill(-1)
+            self._search_cache_expires.fill(0.0)
+            self._search_cache_documents = [None] * self.search_cache_size
+            self._search_cache_next = 0
+            self._query_cache.clear()
+    
+    def _store_query_cache(self, key: Tuple[str, int], result: Dict[str, Any]) -> Dict[str, Any]:
+        """Store a copy of a query result in the LRU cache and return the result"""
+        # Deep copies keep callers from mutating the lists shared by later hits
+        cached = copy.deepcopy(result)
+        with self._search_cache_lock:
+            self._query_cache[key] = (time.monotonic() + self.query_cache_ttl, cached)
+            self._query_cache.move_to_end(key)
+            while len(self._query_cache) > self.query_cache_size:
+                self._query_cache.popitem(last=False)
+        return result
+    
     def _sanitize_metadata(self, metadata: Dict) -> Dict:
         """Convert metadata to Pinecone-compatible types"""
-        sanitized = {}
-        for k, v in metadata.items():
-            if isinstance(v, (str, int, float, bool)):
-                sanitized[k] = v
-            elif isinstance(v, list):
-                sanitized[k] = [str(item) for item in v]
-            elif isinstance(v, dict):
-                sanitized[k] = json.dumps(v, ensure_ascii=False)
-            else:
-                sanitized[k] = str(v)
-        return sanitized
+        return {
+            k: _METADATA_CONVERTERS.get(type(v), _convert_metadata_value)(v)
+            for k, v in metadata.items()
+        }
+    
+    def _iter_entry_batches(self, f, batch_size: int):
+        """Stream valid (id, text, metadata) entries from a JSON array file in batches"""
+        batch = []
+        for entry in ijson.items(f, "item", use_float=True):
+            entry_id = entry.get("id")
+            text = entry.get("text")
+            metadata = entry.get("metadata", {})
+            
+            if not entry_id or not text:
+                continue
+            
+            batch.append((entry_id, text, metadata))
+            if len(batch) == batch_size:
+                yield batch
+                batch = []
+        
+        if batch:
+            yield batch
+    
+    def _build_vectors(self, entries: List[tuple]) -> List[tuple]:
+        """Embed (id, text, metadata) entries and build Pinecone vectors"""
+        # Get embeddings in batched requests instead of one call per entry
+        embeddings = self.get_embeddings([text for _, text, _ in entries])
+        
+        vectors = []
+        for (entry_id, text, metadata), embedding in zip(entries, embeddings):
+            # Sanitize metadata
+            metadata = self._sanitize_metadata(metadata)
+            metadata["text"] = text  # Store original text for retrieval
+            
+            vectors.append((entry_id, embedding, metadata))
+        return vectors
     
     def load_data_to_index(self, json_path: str) -> bool:
         """Load travel data to Pinecone index"""
         try:
-            with open(json_path, "r", encoding="utf-8") as f:
-                data = json.load(f)
-            
-            vectors = []
-            for entry in data:
-                entry_id = entry.get("id")
-                text = entry.get("text")
-                metadata = entry.get("metadata", {})
-                
-                if not entry_id or not text:
-                    continue
-                
-                # Get embedding
-                embedding = self.get_embedding(text)
-                
-                # Sanitize metadata
-                metadata = self._sanitize_metadata(metadata)
-                metadata["text"] = text  # Store original text for retrieval
-                
-                vectors.append((entry_id, embedding, metadata))
-            
-            if vectors:
-                # Upsert in batches
-                batch_size = 100
-                for i in range(0, len(vectors), batch_size):
-                    batch = vectors[i:i + batch_size]
-                    self.index.upsert(batch)
+            # Stream the file: parse, embed and upsert chunk by chunk so memory
+            # use does not grow with the file size
+            batch_size = 100
+            max_workers = 8
+            max_pending = 2 * max_workers  # bounds the vector batches held in memory
+            pending = {}
+            total_batches = 0
+            total_vectors = 0
+            failed_batches = []
+            
+            def collect(done):
+                for future in done:
+                    batch_number = pending.pop(future)
+                    try:
+                        future.result()
+                    except Exception as e:
+                        logger.error(f"Error upserting batch {batch_number}: {e}")
+                        failed_batches.append(batch_number)
+            
+            with open(json_path, "rb") as f, ThreadPoolExecutor(max_workers=max_workers) as pool:
+                for entries in self._iter_entry_batches(f, 256):
+                    vectors = self._build_vectors(entries)
+                    total_vectors += len(vectors)
+                    
+                    # Upsert in batches, several requests in flight at once
+                    for i in range(0, len(vectors), batch_size):
+                        if len(pending) >= max_pending:
+                            # Wait for a slot so a slow index cannot queue up every batch
+                            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                            collect(done)
+                        pending[pool.submit(self.index.upsert, vectors[i:i + batch_size])] = total_batches
+                        total_batches += 1
                 
-                logger.info(f"Successfully loaded {len(vectors)} vectors to index")
-                return True
-            else:
+                collect(as_completed(list(pending)))
+            
+            if not total_vectors:
                 logger.warning("No vectors to load")
                 return False
+            
+            if failed_batches:
+                logger.error(f"Failed to upsert batches {sorted(failed_batches)} of {total_batches}")
+                return False
+            
+            logger.info(f"Successfully loaded {total_vectors} vectors to index")
+            return True
                 
         except Exception as e:
             logger.error(f"Error loading data to index: {e}")
             return False
+        finally:
+            self.clear_cache()
     
     def _ensure_data_loaded(self):
         """Ensure data is loaded in the index"""
@@ -149,12 +356,29 @@ class PineconeRAGSystem:
         except Exception as e:
             logger.error(f"Error checking index stats: {e}")
     
-    def search(self, query: str, top_k: int = 5) -> List[Dict]:
-        """Search similar documents in the index"""
+    def search(self, query: str, top_k: int = 5, use_cache: bool = False) -> List[Dict]:
+        """
+        Search similar documents in the index
+        
+        Args:
+            query: Text to search for
+            top_k: Number of documents to return
+            use_cache: Reuse results of a near-identical recent query. Only
+                suitable for question answering, not exact record lookups.
+        """
         try:
             # Get query embedding
             query_embedding = self.get_embedding(query)
             
+            # Reuse results of a near-identical recent query
+            if use_cache:
+                query_vector = np.asarray(query_embedding, dtype=np.float32)
+                query_vector /= np.linalg.norm(query_vector) or 1.0
+                cached = self._lookup_search_cache(query_vector, top_k)
+                if cached is not None:
+                    logger.info("Search cache hit")
+                    return cached
+            
             # Search in Pinecone
             results = self.index.query(
                 vector=query_embedding,
@@ -172,7 +396,10 @@ class PineconeRAGSystem:
                     "metadata": match.get("metadata", {})
                 })
             
-            return documents
+            if use_cache and documents:
+                self._store_search_cache(query_vector, top_k, documents)
+            
+            return list(documents)
             
         except Exception as e:
             logger.error(f"Error searching: {e}")
@@ -189,9 +416,19 @@ class PineconeRAGSystem:
         Returns:
             Dict with answer and source documents
         """
+        # Repeated questions differing only in case or spacing reuse the answer
+        cache_key = (" ".join(question.lower().split()), top_k)
+        with self._search_cache_lock:
+            cached = self._query_cache.get(cache_key)
+            if cached is not None:
+                if cached[0] > time.monotonic():
+                    self._query_cache.move_to_end(cache_key)
+                    return copy.deepcopy(cached[1])
+                del self._query_cache[cache_key]
+        
         try:
             # Search for relevant documents
-            documents = self.search(question, top_k)
+            documents = self.search(question, top_k, use_cache=True)
             
             # Filter documents by relevance score (minimum threshold)
             min_score = 0.5  # Lowered threshold for better coverage
@@ -200,6 +437,7 @@ class PineconeRAGSystem:
             logger.info(f"Found {len(documents)} total docs, {len(relevant_docs)} above threshold {min_score}")
             
             if not relevant_docs:
+                # Not cached, so the answer appears as soon as matching data is added
                 logger.info("No relevant docs found, returning no_relevant_info")
                 return {
                     "answer": None,  # Signal that no relevant info was found
@@ -233,13 +471,16 @@ class PineconeRAGSystem:
             
             logger.info(f"Final sources to display: {used_sources}")
             
-            return {
+            response = {
                 "answer": result["answer"],
                 "source_documents": relevant_docs,
                 "context_used": context,
                 "sources": used_sources,  # Sources to display (used or fallback)
                 "all_sources": [doc["id"] for doc in relevant_docs]  # All retrieved sources
             }
+            if "error" in result or result["answer"] is None:
+                return response
+            return self._store_query_cache(cache_key, response)
             
         except Exception as e:
             logger.error(f"Error in query: {e}")
@@ -251,46 +492,26 @@ class PineconeRAGSystem:
                 "error": str(e)
             }
     
+    def _chat_completion(self, messages: List[Dict]) -> str:
+        """Run a chat completion and return the stripped answer text"""
+        response = self.chat_client.chat.completions.create(
+            model="GPT-4o-mini",
+            messages=messages,
+            temperature=0.7,
+            max_tokens=500
+        )
+        
+        return response.choices[0].message.content.strip()
+    
     def _generate_answer_with_sources(self, question: str, context: str, chunk_mapping: Dict) -> Dict[str, Any]:
         """Generate answer and track which chunks were actually used"""
         try:
-            client = AzureOpenAI(
-                api_key=self.azure_chat_api_key,
-                azure_endpoint=self.azure_chat_endpoint,
-                api_version="2024-07-01-preview"
-            )
-            
-            prompt = f"""
-            Bạn là trợ lý du lịch thông minh chuyên về du lịch Việt Nam.
-            
-            Dựa vào thông tin sau đây để trả lời câu hỏi của khách hàng:
-            
-            THÔNG TIN THAM KHẢO:
-            {context}
+            prompt = f"THÔNG TIN THAM KHẢO:\n{context}\n\nCÂU HỎI: {question}"
             
-            CÂU HỎI: {question}
-            
-            HƯỚNG DẪN QUAN TRỌNG:
-            - Trả lời bằng tiếng Việt
-            - BẮT BUỘC: Khi sử dụng thông tin từ chunk nào, PHẢI ghi [CHUNK_X] ngay sau thông tin đó
-            - Ví dụ: "Hà Nội có Hồ Hoàn Kiếm [CHUNK_1] và phố cổ với 36 phố phường [CHUNK_2]"
-            - Nếu thông tin không đủ để trả lời, hãy trả lời "NO_RELEVANT_INFO"
-            - Chỉ sử dụng thông tin từ các chunk được cung cấp
-            - Trả lời chi tiết và hữu ích
-            
-            Hãy trả lời và nhớ ghi rõ [CHUNK_X] cho mỗi thông tin sử dụng:
-            """
-            
-            response = client.chat.completions.create(
-                model="GPT-4o-mini",
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
-            
-            answer = response.choices[0].message.content.strip()
+            answer = self._chat_completion([
+                {"role": "system", "content": _RAG_SYSTEM_PROMPT},
+                {"role": "user", "content": prompt}
+            ])
             logger.info(f"Raw LLM response: {answer[:200]}...")
             
             # Check if no relevant info found
@@ -302,43 +523,39 @@ class PineconeRAGSystem:
                 }
             
             # Extract which chunks were referenced
-            import re
-            used_chunks = re.findall(r'\[CHUNK_(\d+)\]', answer)
+            used_chunks = _CHUNK_REF_RE.findall(answer)
             logger.info(f"Found chunk references: {used_chunks}")
             
-            used_sources = []
-            for chunk_num in used_chunks:
+            # Map each cited chunk once, in order of first citation
+            used_sources = {}
+            for chunk_num in dict.fromkeys(used_chunks):
                 chunk_id = f"CHUNK_{chunk_num}"
                 if chunk_id in chunk_mapping:
-                    used_sources.append(chunk_mapping[chunk_id])
+                    used_sources[chunk_mapping[chunk_id]] = None
                     logger.info(f"Mapped {chunk_id} to {chunk_mapping[chunk_id]}")
+            used_sources = list(used_sources)
             
             logger.info(f"Used sources: {used_sources}")
             
             # Clean the answer by removing chunk references
-            clean_answer = re.sub(r'\[CHUNK_\d+\]', '', answer).strip()
+            clean_answer = _CHUNK_REF_RE.sub('', answer).strip()
             
             return {
                 "answer": clean_answer,
-                "used_sources": list(set(used_sources))  # Remove duplicates
+                "used_sources": used_sources
             }
             
         except Exception as e:
             logger.error(f"Error generating answer with sources: {e}")
             return {
                 "answer": f"Xin lỗi, có lỗi xảy ra khi tạo câu trả lời: {str(e)}",
-                "used_sources": []
+                "used_sources": [],
+                "error": str(e)
             }
     
     def _generate_answer(self, question: str, context: str) -> str:
         """Generate answer using context and question"""
         try:
-            client = AzureOpenAI(
-                api_key=self.azure_chat_api_key,
-                azure_endpoint=self.azure_chat_endpoint,
-                api_version="2024-07-01-preview"
-            )
-            
             prompt = f"""
             Bạn là trợ lý du lịch thông minh chuyên về du lịch Việt Nam.
             
@@ -359,16 +576,9 @@ class PineconeRAGSystem:
             TRẢ LỜI:
             """
             
-            response = client.chat.completions.create(
-                model="GPT-4o-mini",
-                messages=[
-                    {"role": "user", "content": prompt}
-                ],
-                temperature=0.7,
-                max_tokens=500
-            )
-            
-            return response.choices[0].message.content.strip()
+            return self._chat_completion([
+                {"role": "user", "content": prompt}
+            ])
             
         except Exception as e:
             logger.error(f"Error generating answer: {e}")
@@ -387,12 +597,38 @@ class PineconeRAGSystem:
             logger.error(f"Error getting index stats: {e}")
             return {}
     
+    def upsert(self, vectors: List[tuple]) -> None:
+        """Insert or update (id, embedding, metadata) vectors in the index"""
+        self.index.upsert(vectors)
+        self.clear_cache()
+    
+    def delete(self, ids: List[str]) -> None:
+        """Delete vectors from the index by ID"""
+        self.index.delete(ids=ids)
+        self.clear_cache()
+    
     def delete_all_vectors(self) -> bool:
         """Delete all vectors from index"""
         try:
             self.index.delete(delete_all=True)
+            self.clear_cache()
             logger.info("All vectors deleted from index")
             return True
         except Exception as e:
             logger.error(f"Error deleting vectors: {e}")
-            return False
\ No newline at end of file
+            return False
+
+
+@lru_cache(maxsize=1)
+def get_rag_system() -> PineconeRAGSystem:
+    """
+    Return the process-wide PineconeRAGSystem, creating it on first call
+    
+    Sharing one instance avoids repeating the Pinecone index setup and stats
+    round trips for every agent, and lets all sessions share its caches.
+    Cached entries expire on their own; call clear_cache() on the instance
+    after editing the index so every session sees the change immediately.
+    Failed initialisations are not cached. Use get_rag_system.cache_clear()
+    to force a fresh instance.
+    """
+    return PineconeRAGSystem()
\ No newline at end of file
@@ -8,14 +8,63 @@ from langchain.agents import initialize_agent, Tool
 from langchain_openai import ChatOpenAI
 from langchain.prompts import PromptTemplate
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import json
+import time
 import warnings
+import weakref
 import logging
-from .pinecone_rag_system import PineconeRAGSystem
+from .pinecone_rag_system import get_rag_system
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
+# Confirmation message returned by the BookHotel tool
+_HOTEL_BOOKING_TEMPLATE = (
+    "✅ Đặt khách sạn thành công!\n"
+    "🏨 Khách sạn: {hotel}\n"
+    "📍 Thành phố: {city}\n"
+    "📅 Ngày: {date}\n"
+    "🌙 Số đêm: {nights}\n"
+    "💰 Giá: {price}\n"
+    "🔖 Mã xác nhận: {confirmation}"
+)
+
+# Confirmation message returned by the BookCar tool
+_CAR_BOOKING_TEMPLATE = (
+    "✅ Đặt xe thành công!\n"
+    "🚗 Loại xe: {car_type}\n"
+    "📍 Điểm đón: {pickup}\n"
+    "🎯 Điểm đến: {destination}\n"
+    "📅 Ngày: {date}\n"
+    "👨‍✈️ Tài xế: {driver}\n"
+    "💰 Giá: {price}\n"
+    "🔖 Mã xác nhận: {confirmation}"
+)
+
+
+# Planner instructions prepended to every agent input
+_PLANNER_SYSTEM_PROMPT = """\
+Bạn là AI Travel Planner chuyên nghiệp cho du lịch Việt Nam.
+
+Nhiệm vụ của bạn:
+1. Tư vấn điểm đến du lịch
+2. Lập kế hoạch chi tiết
+3. Cung cấp thông tin thời tiết khi cần
+4. Hỗ trợ đặt khách sạn
+5. Hỗ trợ đặt xe/vận chuyển
+6. Đưa ra gợi ý hoạt động phù hợp
+
+Hãy sử dụng các tools có sẵn để:
+- TravelKnowledgeSearch: Tìm thông tin du lịch
+- WeatherInfo: Kiểm tra thời tiết
+- BookHotel: Đặt khách sạn khi khách hàng yêu cầu
+- BookCar: Đặt xe/vận chuyển khi khách hàng yêu cầu
+
+Trả lời bằng tiếng Việt, thân thiện và chi tiết.
+"""
+
 
 class TravelPlannerAgent:
     """
@@ -37,10 +86,37 @@ class TravelPlannerAgent:
             import urllib3
             urllib3.disable_warnings(urllib3.exceptions.InsecureRequestWarning)
         
+        # Shared HTTP session so tool calls reuse pooled keep-alive connections
+        self._http = requests.Session()
+        self._http.headers.update({"User-Agent": "ai-travel-assistant"})
+        self._http.mount("https://", HTTPAdapter(
+            pool_connections=10,
+            pool_maxsize=50,
+            # Retry connect errors and 5xx only, with our own short backoff: a stalled
+            # read fails after one timeout, a 429 is not retried against the rate limit,
+            # and a server Retry-After cannot stall the request.
+            # Exhausted status retries return the response for the status_code check.
+            max_retries=Retry(
+                total=2,
+                read=0,
+                backoff_factor=0.2,
+                status_forcelist=[500, 502, 503, 504],
+                respect_retry_after_header=False,
+                raise_on_status=False
+            )
+        ))
+        # Close the pool when the agent is garbage collected or at interpreter exit
+        self._close_http = weakref.finalize(self, self._http.close)
+        
+        # Weather reports cached per city: {city: (expires_at, report)}
+        self.weather_cache_ttl = 300  # seconds
+        self.weather_cache_size = 256
+        self._weather_cache = {}
+        
         # Initialize Pinecone RAG system
         try:
             logger.info("Initializing Pinecone RAG system...")
-            self.rag_system = PineconeRAGSystem()
+            self.rag_system = get_rag_system()
             logger.info(f"Pinecone RAG system initialized successfully")
         except Exception as e:
             logger.error(f"Failed to initialize Pinecone RAG system: {e}")
@@ -52,6 +128,10 @@ class TravelPlannerAgent:
         self.no_relevant_info = False
         self.fallback_query = ""
         
+        # Chat history window sent to the agent (bounds prompt size per turn)
+        self.max_history_turns = 6
+        self.max_history_chars = 500
+        
         # Initialize LLM  
         try:
             from langchain_openai import AzureChatOpenAI
@@ -105,9 +185,18 @@ class TravelPlannerAgent:
         
         def weather_tool(city: str) -> str:
             """Get weather information for a city"""
+            cache_key = city.strip().lower()
+            cached = self._weather_cache.get(cache_key)
+            if cached and cached[0] > time.monotonic():
+                return cached[1]
+            
             try:
-                url = f"https://api.openweathermap.org/data/2.5/weather?q={city}&appid={self.weather_api_key}&units=metric"
-                response = requests.get(url, timeout=10, verify=self.verify_ssl)
+                response = self._http.get(
+                    "https://api.openweathermap.org/data/2.5/weather",
+                    params={"q": city, "appid": self.weather_api_key, "units": "metric"},
+                    timeout=(3, 10),  # (connect, read) seconds
+                    verify=self.verify_ssl
+                )
                 
                 if response.status_code != 200:
                     return f"Không tìm thấy thông tin thời tiết cho {city}"
@@ -120,6 +209,17 @@ class TravelPlannerAgent:
                     f"- Độ ẩm: {data['main']['humidity']}%\n"
                     f"- Tốc độ gió: {data['wind']['speed']} m/s"
                 )
+                
+                # Drop expired reports, then the oldest ones, to stay bounded
+                if len(self._weather_cache) >= self.weather_cache_size:
+                    now = time.monotonic()
+                    self._weather_cache = {
+                        key: value for key, value in self._weather_cache.items() if value[0] > now
+                    }
+                    while len(self._weather_cache) >= self.weather_cache_size:
+                        del self._weather_cache[next(iter(self._weather_cache))]
+                self._weather_cache[cache_key] = (time.monotonic() + self.weather_cache_ttl, weather_info)
+                
                 return weather_info
                 
             except Exception as e:
@@ -144,17 +244,7 @@ class TravelPlannerAgent:
                     "price": f"${nights * 120}"
                 }
                 
-                result = (
-                    f"✅ Đặt khách sạn thành công!\n"
-                    f"🏨 Khách sạn: {booking_info['hotel']}\n"
-                    f"📍 Thành phố: {booking_info['city']}\n"
-                    f"📅 Ngày: {booking_info['date']}\n"
-                    f"🌙 Số đêm: {booking_info['nights']}\n"
-                    f"💰 Giá: {booking_info['price']}\n"
-                    f"🔖 Mã xác nhận: {booking_info['confirmation']}"
-                )
-                
-                return result
+                return _HOTEL_BOOKING_TEMPLATE.format_map(booking_info)
                 
             except Exception as e:
                 return f"Lỗi đặt khách sạn: {str(e)}"
@@ -180,18 +270,7 @@ class TravelPlannerAgent:
                     "price": "500,000 VND"
                 }
                 
-                result = (
-                    f"✅ Đặt xe thành công!\n"
-                    f"🚗 Loại xe: {booking_info['car_type']}\n"
-                    f"📍 Điểm đón: {booking_info['pickup']}\n"
-                    f"🎯 Điểm đến: {booking_info['destination']}\n"
-                    f"📅 Ngày: {booking_info['date']}\n"
-                    f"👨‍✈️ Tài xế: {booking_info['driver']}\n"
-                    f"💰 Giá: {booking_info['price']}\n"
-                    f"🔖 Mã xác nhận: {booking_info['confirmation']}"
-                )
-                
-                return result
+                return _CAR_BOOKING_TEMPLATE.format_map(booking_info)
                 
             except Exception as e:
                 return f"Lỗi đặt xe: {str(e)}"
@@ -245,26 +324,11 @@ class TravelPlannerAgent:
             if chat_history is None:
                 chat_history = []
             
-            # Create travel planning prompt
-            system_prompt = """
-            Bạn là AI Travel Planner chuyên nghiệp cho du lịch Việt Nam.
-            
-            Nhiệm vụ của bạn:
-            1. Tư vấn điểm đến du lịch
-            2. Lập kế hoạch chi tiết
-            3. Cung cấp thông tin thời tiết khi cần
-            4. Hỗ trợ đặt khách sạn
-            5. Hỗ trợ đặt xe/vận chuyển
-            6. Đưa ra gợi ý hoạt động phù hợp
-            
-            Hãy sử dụng các tools có sẵn để:
-            - TravelKnowledgeSearch: Tìm thông tin du lịch
-            - WeatherInfo: Kiểm tra thời tiết
-            - BookHotel: Đặt khách sạn khi khách hàng yêu cầu
-            - BookCar: Đặt xe/vận chuyển khi khách hàng yêu cầu
-            
-            Trả lời bằng tiếng Việt, thân thiện và chi tiết.
-            """
+            # Keep only the most recent turns, each truncated, to cap prompt size
+            chat_history = [
+                (role, content[:self.max_history_chars])
+                for role, content in chat_history[-self.max_history_turns * 2:]
+            ]
             
             # Clear previous sources and reset flags
             self.last_rag_sources = []
@@ -273,7 +337,7 @@ class TravelPlannerAgent:
             
             # Run agent
             response = self.agent.run({
-                "input": f"{system_prompt}\n\nYêu cầu của khách hàng: {user_input}",
+                "input": f"{_PLANNER_SYSTEM_PROMPT}\n\nYêu cầu của khách hàng: {user_input}",
                 "chat_history": chat_history
             })
             
@@ -356,4 +420,8 @@ class TravelPlannerAgent:
                 "success": False,
                 "response": f"Lỗi RAG: {str(e)}",
                 "error": str(e)
-            }
\ No newline at end of file
+            }
+    
+    def close(self):
+        """Release pooled HTTP connections"""
+        self._close_http()
\ No newline at end of file